@@ -1,11 +1,30 @@
 import os
+import glob
+import asyncio
+import hashlib
+import numpy as np
 import rioxarray 
 import xarray as xr
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-import ipywidgets
-from datetime import datetime
+
+def debounce(wait):
+    """Decorator that delays calls to a function until `wait` seconds
+    have passed without another call (only the last call is made).
+
+    Must be called from a running asyncio event loop (e.g. from the 
+    Jupyter kernel's widget callbacks).
+    """
+    def decorator(fn):
+        handle = None
+        def debounced(*args, **kwargs):
+            nonlocal handle
+            if handle is not None:
+                handle.cancel()
+            loop = asyncio.get_running_loop()
+            handle = loop.call_later(wait, lambda: fn(*args, **kwargs))
+        return debounced
+    return decorator
+
 
 class trend(object):
     def __init__(self, nc_file, shp):
@@ -26,13 +45,44 @@ class trend(object):
         self.xr = self._load_data()
         self.shp = shp
         self.xrc = self._clip_data()
-        self.ts = self._reduce_ts()
+        # The reduced time series only depends on the netcdf file and the
+        # shape, so it is cached next to the netcdf file. Loading and clipping
+        # above are lazy (cheap), the expensive part is the reduction:
+        ts_file = self._ts_cache_file()
+        ts = self._read_cache(ts_file, pd.read_parquet)
+        if ts is None:
+            ts = self._reduce_ts()
+            self._write_cache(ts_file, ts.to_parquet)
+        # The time series is kept as two aligned numpy arrays
+        # (see the ts property for a pandas DataFrame):
+        self._t = ts.index.values.astype("datetime64[ns]").view("int64")
+        self._y = np.ascontiguousarray(ts["twsa"].values, dtype=np.float32)
+        self._ts = None
+        self._prepare_trend()
+
+    @property
+    def ts(self):
+        """The TWSA time series (in mm) as a pandas DataFrame
+        """
+        if self._ts is None:
+            self._ts = pd.DataFrame(
+                {"twsa": self._y},
+                index=pd.DatetimeIndex(self._t.view("datetime64[ns]"), name="date")
+            )
+        return self._ts
 
 
     def _load_data(self):
-        """Loads the netcdf data as an xarray.Dataset
+        """Loads the netcdf data as a lazy (dask-backed) xarray.Dataset
+
+        Nothing is read from disk here: the values are only pulled
+        (chunk by chunk) once the clipped data is reduced to a time series.
         """
-        csr_data = xr.open_dataset(self.nc_file)
+        # time_bounds and the WGS84 (crs) variables are not used, so they are not read:
+        # chunks={} uses the chunks stored in the netcdf (HDF5) file, so that
+        # each dask chunk is read and decompressed exactly once:
+        csr_data = xr.open_dataset(self.nc_file, chunks={}, decode_cf=False,
+            drop_variables=["time_bounds", "WGS84"])
         # Technical note: the netcdf above breaks a CF convention
         # by capitalizing the units attribute (i.e. should be "units" and not "Units"). 
         # Here we assign the correct one (not capitalized) so that xarray
@@ -40,19 +90,137 @@ class trend(object):
         csr_data.time.attrs.update(units=csr_data.time.Units)
         csr_data = (xr.decode_cf(csr_data)
         .rename({'lon':'x', 'lat':'y'})
-        .drop_vars("time_bounds")
         .rio.write_crs("epsg:4326")
         )
+        # Decoding may promote the data to float64, float32 is enough
+        # (and halves the memory of the clipped data):
+        csr_data["lwe_thickness"] = csr_data.lwe_thickness.astype("float32")
         return csr_data
 
 
+    def _cache_key(self):
+        """Keys of the cached files for this shape and netcdf file
+
+        Returns the key of the shape and the key of the netcdf file,
+        which changes whenever the file is updated (modification
+        time and size).
+        """
+        shape_key = "{}:{}".format(
+            self.shp.crs,
+            "".join(geom.wkb_hex for geom in self.shp.geometry)
+        )
+        nc_key = "{}:{}".format(
+            os.path.getmtime(self.nc_file),
+            os.path.getsize(self.nc_file)
+        )
+        return tuple(hashlib.sha1(key.encode()).hexdigest()[:16] 
+            for key in (shape_key, nc_key))
+
+
+    def _cache_file(self, name, ext):
+        """Path of a cached file (e.g. name="ts") for this netcdf file and shape
+        """
+        shape_key, nc_key = self._cache_key()
+        return f"{self.nc_file}.{name}-{shape_key}-{nc_key}.{ext}"
+
+
+    @staticmethod
+    def _read_cache(cache_file, read):
+        """Reads a cached file using read(cache_file)
+
+        Returns None if the file doesn't exist or can't be read 
+        (e.g. it is truncated), so that the caller computes it again.
+        """
+        if not os.path.isfile(cache_file):
+            return None
+        try:
+            return read(cache_file)
+        except Exception:
+            return None
+
+
+    @staticmethod
+    def _write_cache(cache_file, write):
+        """Writes a cached file using write(file_object)
+
+        The data is written to a temporary file that is then moved into 
+        place, so a partially written cache file is never read. 
+        The cache is optional: errors writing it (e.g. read-only data 
+        directory) are ignored. 
+        Once written, the versions of the same cache for an older netcdf 
+        file (same shape, e.g. before update_data) are removed.
+        """
+        def remove(file_name):
+            try:
+                os.remove(file_name)
+            except OSError:
+                pass
+
+        tmp_file = f"{cache_file}.{os.getpid()}.part"
+        try:
+            with open(tmp_file, "wb") as f:
+                write(f)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            remove(tmp_file)
+            return
+        prefix = cache_file.rsplit("-", 1)[0] + "-" # i.e. up to the shape key
+        ext = os.path.splitext(cache_file)[1]
+        for old_file in glob.glob(glob.escape(prefix) + "*" + ext):
+            if old_file != cache_file:
+                remove(old_file)
+
+
+    def _ts_cache_file(self):
+        """Path of the cached time series for this netcdf file and shape
+        """
+        return self._cache_file("ts", "parquet")
+
+
+    def _mask_cache_file(self):
+        """Path of the cached shape mask for this netcdf file and shape
+        """
+        return self._cache_file("mask", "npy")
+
+
     def _clip_data(self):
         """Clips the dataset to the geometry in the shp
         1. First clips to the bounding box
         2. Then clips to the shape
+
+        Both steps are lazy: the bounding box is a plain label-based
+        selection, so only the chunks that intersect it are read later on.
+        The shape is applied as a mask of the pixels inside it, which is
+        rasterized once and cached next to the netcdf file.
         """
-        csr_data_box = self.xr.rio.clip_box(**self.shp.bounds.iloc[0].to_dict())  
-        clipped = csr_data_box.rio.clip(self.shp.geometry.values, self.shp.crs).drop("WGS84") 
+        bounds = self.shp.bounds.iloc[0]
+        y = self.xr.y.values
+        if y[0] > y[-1]: # y is descending
+            y_slice = slice(bounds.maxy, bounds.miny)
+        else:
+            y_slice = slice(bounds.miny, bounds.maxy)
+        csr_data_box = self.xr.sel(x=slice(bounds.minx, bounds.maxx), y=y_slice)
+        mask_file = self._mask_cache_file()
+        mask = self._read_cache(mask_file, np.load)
+        if mask is not None:
+            mask = mask.astype(bool)
+        else:
+            from rasterio.features import geometry_mask
+            mask = geometry_mask(
+                self.shp.to_crs(csr_data_box.rio.crs).geometry.values,
+                out_shape=(csr_data_box.y.size, csr_data_box.x.size),
+                transform=csr_data_box.rio.transform(),
+                invert=True # True inside the shape
+            )
+            self._write_cache(mask_file, lambda f: np.save(f, mask.astype("uint8")))
+        # Like rio.clip(drop=True), drop the rows and columns of the 
+        # box that are entirely outside the shape:
+        rows = mask.any(axis=1)
+        cols = mask.any(axis=0)
+        clipped = (csr_data_box
+        .isel(y=rows, x=cols)
+        .where(xr.DataArray(mask[rows][:, cols], dims=("y", "x")))
+        )
         return clipped
 
 
@@ -66,23 +234,44 @@ class trend(object):
         """
         csr_file = self.nc_file 
         import requests
-        r = requests.get(self.csr_url)
-        grace_data = r.content
-        with open(csr_file, 'wb') as f:
-            f.write(grace_data)
+        import shutil
+        # Stream the response straight to disk (1 MB at a time) instead of
+        # holding the whole file in memory. The data is written to a
+        # temporary file first so that an interrupted download does not
+        # leave a truncated nc file behind.
+        tmp_file = csr_file + ".part"
+        try:
+            with requests.get(self.csr_url, stream=True) as r:
+                r.raise_for_status()
+                r.raw.decode_content = True
+                with open(tmp_file, 'wb') as f:
+                    shutil.copyfileobj(r.raw, f, length=1024*1024)
+            os.replace(tmp_file, csr_file)
+        except BaseException: # including an interrupted (Ctrl+C) download
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
 
 
     def _reduce_ts(self):
         """Reduce the data to a time series (returns a pandas DataFrame)
         Spatial mean at each time to get time series
         """
-        ts_saq = (self.xrc
-        .lwe_thickness.mean(dim=["x","y"]) 
-        .to_dataframe()                    
-        .rename_axis("date")
-        .rename(columns={"lwe_thickness":"twsa"})
+        import bottleneck as bn
+        # This computes the (lazy) clipped data, which is small
+        # after clipping to the bounding box (dask's default threaded
+        # scheduler already processes the chunks in parallel):
+        lwe = (self.xrc.lwe_thickness
+        .transpose("time", "y", "x")
+        .values
+        )
+        # NaN-aware mean over the pixels inside the shape
+        # (bottleneck reduces over a single axis, hence the reshape):
+        twsa = bn.nanmean(lwe.reshape(lwe.shape[0], -1), axis=1)
+        ts_saq = pd.DataFrame(
+            {"twsa": twsa*10}, # cm->mm
+            index=pd.Index(self.xrc.time.values, name="date")
         )
-        ts_saq.twsa = ts_saq.twsa*10 # cm->mm
         return ts_saq
 
     def display_ts(self):
@@ -90,25 +279,57 @@ class trend(object):
         """
         self._create_widgets()
 
-    @staticmethod
-    def _calc_trend_in_mm_year(df, y="twsa"):
+    def _prepare_trend(self):
+        """Precomputes the cumulative sums used by _calc_trend_in_mm_year
+
+        With these, the linear fit over any period only needs a
+        few lookups instead of refitting over the whole period.
+        """
+        ns_per_year = 1e9*3600*24*365
+        # Dates as nanoseconds (self._t, to search the period) and as
+        # years since the first date (to fit the trend directly in mm/year):
+        self._dates = self._t.view("datetime64[ns]")
+        self._x = (self._t - self._t[0])/ns_per_year
+        y = self._y.astype(float)
+        def cumsum(a):
+            return np.concatenate([[0.], np.cumsum(a)])
+        self._C1 = cumsum(np.ones_like(self._x))
+        self._Cx = cumsum(self._x)
+        self._Cy = cumsum(y)
+        self._Cxx = cumsum(self._x*self._x)
+        self._Cxy = cumsum(self._x*y)
+
+    def _calc_trend_in_mm_year(self, start, end):
         """Calculate a linear trend in mm/year
 
-        The dataframe df has the dates as index. 
+        start and end are the dates (in nanoseconds) of the period,
+        both inclusive. 
 
-        Returns the trend and the predicted y values
-        using the linear model. 
+        Returns the trend, and the dates in the period with the
+        predicted y values using the linear model (as numpy arrays). 
+
+        Raises a ValueError if the period has less than 2 dates
+        (including when start is after end).
         """
-        import pandas as pd
-        import sklearn.linear_model
-        model = sklearn.linear_model.LinearRegression()
-        model.fit(df.index.values.reshape(-1, 1), df[y])
-        trend = model.coef_*1e9*3600*24*365  # in mm/year
-        # Note that the .astype(float) makes the date
-        # a numeric value in nanoseconds! 
-        y_pred = model.predict(df.index.values.astype(float).reshape(-1,1))
-        y_pred = pd.Series(y_pred, index=df.index)
-        return trend, y_pred
+        i0 = np.searchsorted(self._t, start, side="left")
+        i1 = np.searchsorted(self._t, end, side="right")
+        if start > end:
+            raise ValueError("The start of the period must be before its end")
+        if i1 - i0 < 2:
+            raise ValueError(
+                "At least 2 dates are needed to calculate the trend, "
+                f"the period has {i1 - i0}"
+            )
+        n = self._C1[i1] - self._C1[i0]
+        Sx = self._Cx[i1] - self._Cx[i0]
+        Sy = self._Cy[i1] - self._Cy[i0]
+        Sxx = self._Cxx[i1] - self._Cxx[i0]
+        Sxy = self._Cxy[i1] - self._Cxy[i0]
+        slope = (n*Sxy - Sx*Sy)/(n*Sxx - Sx*Sx)
+        intercept = (Sy - slope*Sx)/n
+        trend = np.array([slope])  # in mm/year
+        y_pred = slope*self._x[i0:i1] + intercept
+        return trend, self._dates[i0:i1], y_pred
 
     def make_figure(self,Start,End):
         """Makes the figure using Start and End parameters
@@ -117,26 +338,40 @@ class trend(object):
         and a shaded period (defined by Start/End) where we calculate
         a linear trend and display its value in mm.yr⁻¹
         """
+        self._create_figure()
+        self.update_figure(Start, End)
+
+    def _create_figure(self):
+        """Creates the static part of the figure (time series, labels)
+
+        The artists that depend on the selected period (trend line,
+        trend annotation and shaded period) are kept as attributes
+        so that update_figure only needs to modify them.
+        """
+        import matplotlib.pyplot as plt
         #hfont = {'fontname':'Arial'}
         height=2.75
         AR=3.5
         width = height*AR
 
-        data = self.ts.copy()
-        trend, y_pred = self._calc_trend_in_mm_year(data.query("date>=@Start and date<=@End"))   
-        self.trend = trend
-        data = data.assign(linear_twsa=y_pred)
+        dates = self._dates
+        twsa = self._y
 
-        # Preview time series using seaborn
-        og_grace_query="date<='2017-05-23'"
-        gracefo_query="date>='2018-06-01'"
+        # GRACE and GRACE-FO periods, drawn as a single line
+        # with a NaN in between so that the gap is not joined:
+        og_grace = dates <= np.datetime64("2017-05-23")
+        gracefo = dates >= np.datetime64("2018-06-01")
+        gap_date = np.array(["2017-12-01"], dtype=dates.dtype)
+        line_dates = np.concatenate([dates[og_grace], gap_date, dates[gracefo]])
+        line_twsa = np.concatenate([twsa[og_grace], [np.nan], twsa[gracefo]])
 
+        plt.rcParams['svg.fonttype'] = 'none' # so that the
+        # fonts in the exported svg can be edited e.g. in powerpoint.  
         fig =  plt.figure(figsize=(width, height))  
         ax = fig.add_subplot(1, 1, 1)
-        sns.lineplot(data=data.query(og_grace_query), x="date", y="twsa", color="#484848", ax=ax)
-        sns.lineplot(data=data.query(gracefo_query), x="date", y="twsa", ax = ax, color="#484848")
-        # Linear trend:
-        sns.lineplot(data=data.query("date>@Start"), x="date", y="linear_twsa", ax = ax, color="black")
+        ax.plot(line_dates, line_twsa, color="#484848")
+        # Linear trend (updated with the selected period):
+        self._trend_line, = ax.plot([], [], color="black")
 
         ax.set_xlabel("")
         ax.set_ylabel("Total Water Storage A.(mm)", fontsize=14)#, **hfont)
@@ -146,18 +381,32 @@ class trend(object):
         annotate_kws = {"size": 16, "xytext": (0,0), "textcoords": "offset points", "fontweight": "bold"}
         ax.annotate("Saq Aquifer", (pd.to_datetime("2009-01-01"), -150), **annotate_kws)
 
-        # "- X mm.yr^-1" annotation:
-        trend_annot = "{:.2f} mm.yr⁻¹".format(trend[0])
+        # "- X mm.yr^-1" annotation (updated with the selected period):
         annotate_kws = {"size": 16, "xytext": (0,0), "textcoords": "offset points"}
-        ax.annotate(trend_annot, (pd.to_datetime("2009-01-01"), 30), **annotate_kws)
+        self._trend_text = ax.annotate("", (pd.to_datetime("2009-01-01"), 30), **annotate_kws)
 
-        plt.setp(ax.get_yticklabels(), fontsize=14)#, **hfont)
-        plt.setp(ax.get_xticklabels(), fontsize=14)#), **hfont)
-        plt.axvspan(Start, End, facecolor='#D3D3D3')
-        plt.rcParams['svg.fonttype'] = 'none' # so that the
-        # fonts in the exported svg can be edited e.g. in powerpoint.  
-        #fig.canvas.draw()
+        ax.tick_params(labelsize=14)
+        self._span = None
         self.fig = fig 
+        self.ax = ax
+
+    def update_figure(self,Start,End):
+        """Updates the trend line, annotation and shaded period in place
+        """
+        trend, dates, y_pred = self._calc_trend_in_mm_year(pd.Timestamp(Start).value, pd.Timestamp(End).value)
+        self.trend = trend
+        self._trend_line.set_data(dates, y_pred)
+        self._trend_text.set_text("{:.2f} mm.yr⁻¹".format(trend[0]))
+        if self._span is not None:
+            self._span.remove()
+        self._span = self.ax.axvspan(Start, End, facecolor='#D3D3D3')
+        self.fig.canvas.draw_idle()
+
+    def _show_figure(self,Start,End):
+        """Widget callback: updates and displays the figure
+        """
+        self.update_figure(Start, End)
+        display(self.fig)
 
     def to_svg(self, file_name, **kwargs):
         self.fig.savefig(file_name, **kwargs) 
@@ -167,38 +416,58 @@ class trend(object):
         self.fig.savefig(file_name, **kwargs) 
 
     def _create_widgets(self):
+        import ipywidgets
+        import matplotlib.pyplot as plt
+        from datetime import datetime
         default_start_date = datetime(2007, 1, 1)
         default_end_date = datetime(2022, 8, 15)
         start_date = datetime(2002, 1, 1)
         end_date = datetime(2022, 12, 31)
-        dates = pd.date_range(start_date, end_date, freq='D')
-        options = {date.strftime(' %d %b %Y '): date for date in dates}
+        # The slider works on unix time (in seconds, one step per day),
+        # only the two selected dates are formatted (in the label):
+        def to_seconds(date):
+            return pd.Timestamp(date).value // 10**9
+
+        def to_date(seconds):
+            return pd.Timestamp(seconds, unit='s').date()
+
         pick_start = ipywidgets.widgets.DatePicker(
-            description='',
+            description='Start',
             disabled=False,
             value = default_start_date
         )
         pick_end = ipywidgets.widgets.DatePicker(
-            description='',
+            description='End',
             disabled=False,
             value=default_end_date
         )
-        selection_range_slider = ipywidgets.widgets.SelectionRangeSlider(
-            options=options,
-            index=(0, len(options) - 1),
+        range_slider = ipywidgets.widgets.IntRangeSlider(
+            min=to_seconds(start_date),
+            max=to_seconds(end_date),
+            step=24*3600,
+            value=(to_seconds(start_date), to_seconds(end_date)),
             continuous_update=False,
+            readout=False,
             description='Trend period',
             orientation='horizontal',
             layout=ipywidgets.widgets.Layout(width='100%', padding='35px')
         )
+        range_label = ipywidgets.widgets.Label()
         def update_pick(*args):
-            pick_start.value = selection_range_slider.value[0]
-            pick_end.value = selection_range_slider.value[1]
+            # Read both values first: setting pick_start updates the slider
+            start, end = range_slider.value
+            pick_start.value = to_date(start)
+            pick_end.value = to_date(end)
 
         def update_slider(*args):
-            selection_range_slider.value =  (pick_start.value, pick_end.value)
+            range_slider.value = (to_seconds(pick_start.value), to_seconds(pick_end.value))
+
+        def update_label(*args):
+            start, end = (to_date(value) for value in range_slider.value)
+            range_label.value = f"{start:%d %b %Y} - {end:%d %b %Y}"
         
-        selection_range_slider.observe(update_pick, 'value')
+        range_slider.observe(update_pick, 'value')
+        range_slider.observe(update_label, 'value')
         pick_start.observe(update_slider, 'value')
         pick_end.observe(update_slider, 'value')
         center_layout = ipywidgets.widgets.Layout(display='flex',
@@ -206,12 +475,32 @@ class trend(object):
                                                width='100%')
         control = ipywidgets.widgets.HBox(children=[
             #pick_start, 
-            selection_range_slider, 
+            range_slider, 
+            range_label,
             #pick_end
             ], layout=center_layout)
        
 
         update_slider('value')
         display(control)
-        ipywidgets.interact(self.make_figure, Start=pick_start, End=pick_end)
+        self._create_figure()
+        # The figure is displayed explicitly (see _show_figure), 
+        # closing it avoids an extra copy being displayed by the notebook:
+        plt.close(self.fig)
+        # The figure is only redrawn once the values stop changing
+        # (e.g. moving the slider changes both Start and End):
+        output = ipywidgets.widgets.Output()
+        def show_figure(Start, End):
+            with output:
+                output.clear_output(wait=True)
+                self._show_figure(Start, End)
+
+        show_figure_debounced = debounce(0.1)(show_figure)
+        def update_figure(*args):
+            show_figure_debounced(pick_start.value, pick_end.value)
+
+        pick_start.observe(update_figure, 'value')
+        pick_end.observe(update_figure, 'value')
+        display(ipywidgets.widgets.VBox(children=[pick_start, pick_end, output]))
+        show_figure(pick_start.value, pick_end.value)
 